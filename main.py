@@ -1,96 +1,139 @@
-import subprocess
-import re
+import asyncio
 import os
 import logging
-import glob
-import json
 import shutil
+import orjson
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import bigquery
+from google.cloud import storage
+from google.api_core.exceptions import NotFound
+from dap.api import DAPClient
+from dap.dap_types import Credentials, Format, IncrementalQuery, SnapshotQuery
 
 logging.basicConfig(level=logging.INFO)
 
 logging.info("Starting DAP to BigQuery")
 
-def run_dap_command(command, namespace="canvas"):
+MAX_DESCRIPTION_LENGTH = 1024
+
+CACHE_DIRECTORY = "cache"
+SCHEMA_CACHE_DIRECTORY = os.path.join(CACHE_DIRECTORY, "schemas")
+TABLES_CACHE_FILE = os.path.join(CACHE_DIRECTORY, "tables.json")
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_MINUTES", "60")) * 60
+
+# Required configuration, read once so a missing variable fails at startup
+API_KEY = os.environ["API_KEY"]
+API_SECRET = os.environ["API_SECRET"]
+DATASET = os.environ["DATASET"]
+PROJECT = os.environ["PROJECT"]
+STAGING_BUCKET = os.environ["STAGING_BUCKET"]
+
+DAP_BASE_URL = "https://api-gateway.instructure.com"
+DATASET_REF = bigquery.DatasetReference(PROJECT, DATASET)
+LOAD_JOB_CONFIG = bigquery.LoadJobConfig(source_format=bigquery.SourceFormat.PARQUET, write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+
+# Must be a multiple of 256 KB, which any whole number of megabytes is
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE_MB", "100")) * 1024 * 1024
+# Each worker buffers at most one upload chunk, bounding upload memory to MAX_WORKERS * UPLOAD_CHUNK_SIZE
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "8"))
+
+STATE_TABLE_REF = DATASET_REF.table("dap_state")
+STATE_SCHEMA = [
+    bigquery.SchemaField("table_name", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("last_sync", "TIMESTAMP", mode="REQUIRED"),
+    bigquery.SchemaField("schema_version", "INTEGER"),
+]
+STAGING_TABLE_SUFFIX = "__dap_incremental"
+
+async def list_tables(dap_session, namespace="canvas"):
     """
-    Runs a DAP command using the specified command, base URL, client ID, client secret, and namespace.
+    Returns a list of the tables available in a DAP namespace.
+
+    The list is cached in 'cache/tables.json' and reused for CACHE_TTL_MINUTES.
 
     Args:
-        command (str): The DAP command to run.
-        namespace (str, optional): The namespace to use for the command. Defaults to "canvas".
+        dap_session (DAPSession): The DAP API session to list the tables with.
+        namespace (str, optional): The namespace to list the tables of. Defaults to "canvas".
 
     Returns:
-        str: The output of the DAP command.
-
-    Raises:
-        subprocess.CalledProcessError: If the DAP command fails to run.
+        List[str]: The names of the tables.
     """
     try:
-        base_url = "https://api-gateway.instructure.com"
-        client_id = os.getenv("API_KEY")
-        client_secret = os.getenv("API_SECRET")
+        with open(TABLES_CACHE_FILE, 'rb') as file:
+            cache = orjson.loads(file.read())
+        if time.time() - cache["fetched_at"] < CACHE_TTL_SECONDS:
+            return cache["tables"]
+    except (FileNotFoundError, orjson.JSONDecodeError, KeyError):
+        pass
 
-        result = subprocess.run(f"dap --base-url {base_url} --client-id {client_id} --client-secret {client_secret} {command} --namespace {namespace}", 
-                                check=True, shell=True, text=True, capture_output=True)
-        return result.stdout
-    except subprocess.CalledProcessError as e:
-        print(f"Error running command '{command}': {e.output}")
-        return None
+    tables = await dap_session.get_tables(namespace)
 
-def list_tables():
-    """
-    Returns a list of tables by running the 'list' command.
-    """
-    return run_dap_command("list").split()
+    with open(TABLES_CACHE_FILE, 'wb') as file:
+        file.write(orjson.dumps({"fetched_at": time.time(), "tables": tables}))
+    return tables
 
-def download_table_data(table_name):
+async def download_table_data(dap_session, table_name, output_directory="downloads", namespace="canvas"):
     """
     Downloads the data for a given table name in the CanvasData system.
 
     Args:
+        dap_session (DAPSession): The DAP API session to download with.
         table_name (str): The name of the table to download data from.
+        output_directory (str, optional): The directory to download the data to. Defaults to "downloads".
+        namespace (str, optional): The namespace of the table. Defaults to "canvas".
 
     Returns:
-        str: The command to run for downloading the table data in parquet format.
+        DownloadTableDataResult: The downloaded files, the job ID, the schema version and the snapshot's 'at' timestamp.
     """
-    return run_dap_command(f"snapshot --table {table_name} --format parquet")
+    query = SnapshotQuery(format=Format.Parquet, mode=None)
+    return await dap_session.download_table_data(namespace, table_name, query, output_directory)
 
-def download_incremental_table_data(table_name, since_datetime):
+async def download_incremental_table_data(dap_session, table_name, since_datetime, output_directory="downloads", namespace="canvas"):
     """
     Downloads incremental table data in parquet format since the specified datetime.
 
     Args:
+        dap_session (DAPSession): The DAP API session to download with.
         table_name (str): The name of the table to download data from.
-        since_datetime (str): The datetime from which to start downloading data.
+        since_datetime (datetime): The 'at' or 'until' timestamp returned by the previous download of the table.
+        output_directory (str, optional): The directory to download the data to. Defaults to "downloads".
+        namespace (str, optional): The namespace of the table. Defaults to "canvas".
 
     Returns:
-        str: The result of the DAP command for downloading the data.
+        DownloadTableDataResult: The downloaded files, the job ID, the schema version and the increment's 'until' timestamp.
     """
-    return run_dap_command(f"incremental --table {table_name} --format parquet --since {since_datetime}")
+    query = IncrementalQuery(format=Format.Parquet, mode=None, since=since_datetime, until=None)
+    return await dap_session.download_table_data(namespace, table_name, query, output_directory)
 
-def download_table_schema(table_name):
+async def download_table_schema(dap_session, table_name, output_directory="downloads", namespace="canvas"):
     """
-    Downloads the schema for a given table.
+    Downloads the current schema for a given table.
+
+    The schema is saved as '<table>_schema_version_<version>.json' in the output directory,
+    unless that file already exists: a schema version never changes once published.
 
     Args:
+        dap_session (DAPSession): The DAP API session to download with.
         table_name (str): The name of the table.
+        output_directory (str, optional): The directory to save the schema to. Defaults to "downloads".
+        namespace (str, optional): The namespace of the table. Defaults to "canvas".
 
     Returns:
-        str: The schema of the table.
+        Tuple[int, str]: The version of the schema and the path to its file.
     """
-    return run_dap_command(f"schema --table {table_name}")
+    versioned_schema = await dap_session.get_table_schema(namespace, table_name)
+    schema_file = os.path.join(output_directory, f"{table_name}_schema_version_{versioned_schema.version}.json")
 
-def get_job_id():
-    """
-    Get the job ID of the latest directory in the 'downloads' folder.
+    if not os.path.exists(schema_file):
+        # Write to a temporary file first so an interrupted run never leaves a partial schema behind
+        with tempfile.NamedTemporaryFile('wb', dir=output_directory, delete=False) as file:
+            file.write(orjson.dumps({"schema": versioned_schema.schema, "version": versioned_schema.version}))
+        os.replace(file.name, schema_file)
 
-    Returns:
-        str or None: The job ID of the latest directory, or None if no directories exist.
-    """
-    dirs = next(os.walk('downloads'))[1]
-    if dirs:
-        return dirs[0]  # Assuming the latest directory is the relevant one
-    return None
+    return versioned_schema.version, schema_file
 
 def load_json_schema(file_path):
     """
@@ -104,77 +147,85 @@ def load_json_schema(file_path):
 
     Raises:
         FileNotFoundError: If the file does not exist.
-        json.JSONDecodeError: If the file contains invalid JSON.
+        orjson.JSONDecodeError: If the file contains invalid JSON.
     """
-    with open(file_path, 'r') as file:
-        return json.load(file)
+    with open(file_path, 'rb') as file:
+        return orjson.loads(file.read())
 
-def schema_field_to_dict(field):
+def flatten_descriptions(json_schema, prefix=""):
     """
-    Convert a SchemaField to a dictionary.
+    Flatten the field descriptions of a JSON schema into dotted field paths.
 
     Args:
-        field (SchemaField): The SchemaField object to convert.
+        json_schema (dict): JSON schema containing field descriptions.
+        prefix (str, optional): The path of the enclosing field, including the trailing dot. Defaults to "".
 
-    Returns:
-        dict: A dictionary representation of the SchemaField.
-    """
-    result = {
-        "name": field.name,
-        "type": field.field_type,
-        "mode": field.mode,
-        "description": field.description,
-    }
-    if field.field_type == 'RECORD':
-        result["fields"] = [schema_field_to_dict(f) for f in field.fields]
-    return result
+    Yields:
+        Tuple[str, str]: The dotted path of each described field and its description, truncated to BigQuery's limit.
+    """
+    for name, json_field in json_schema.get('properties', {}).items():
+        path = f"{prefix}{name}"
+        if 'description' in json_field:
+            yield path, json_field['description'][:MAX_DESCRIPTION_LENGTH]
+        yield from flatten_descriptions(json_field, f"{path}.")
 
-def update_schema_description(bq_schema_fields, json_schema):
+def apply_descriptions(bq_schema_fields, descriptions, prefix=""):
     """
-    Update the description of BigQuery schema fields based on a JSON schema.
+    Apply descriptions keyed by dotted field path to BigQuery schema fields.
+
+    Only fields whose description, or a nested field's description, actually changes
+    are rebuilt; unchanged fields are returned as they are.
 
     Args:
         bq_schema_fields (List[bigquery.SchemaField]): List of BigQuery schema fields.
-        json_schema (dict): JSON schema containing field descriptions.
+        descriptions (dict): Field descriptions keyed by dotted field path.
+        prefix (str, optional): The path of the enclosing field, including the trailing dot. Defaults to "".
 
     Returns:
-        List[bigquery.SchemaField]: Updated list of BigQuery schema fields with updated descriptions.
+        Tuple[List[bigquery.SchemaField], bool]: The updated schema fields, and whether any of them changed.
     """
     updated_fields = []
-    max_description_length = 1024
+    changed = False
 
     for field in bq_schema_fields:
-        json_field = json_schema.get('properties', {}).get(field.name)
-        description = field.description
-
-        if json_field:
-            if 'description' in json_field:
-                # Truncate the description if it's too long
-                description = json_field['description'][:max_description_length]
-
-            if field.field_type == 'RECORD':
-                nested_fields = update_schema_description(field.fields, json_field) if field.fields else []
-                new_field = bigquery.SchemaField(
-                    name=field.name,
-                    field_type=field.field_type,
-                    mode=field.mode,
-                    description=description,
-                    fields=nested_fields
-                )
-            else:
-                new_field = bigquery.SchemaField(
-                    name=field.name,
-                    field_type=field.field_type,
-                    mode=field.mode,
-                    description=description
-                )
-        else:
-            # If json_field is None, use the original field
+        path = f"{prefix}{field.name}"
+        description = descriptions.get(path, field.description)
+        # SchemaField.fields builds a new tuple on every access
+        nested_fields = field.fields
+        nested_changed = False
+
+        if field.field_type == 'RECORD' and nested_fields:
+            nested_fields, nested_changed = apply_descriptions(nested_fields, descriptions, f"{path}.")
+
+        if description == field.description and not nested_changed:
             new_field = field
+        else:
+            changed = True
+            new_field = bigquery.SchemaField(
+                name=field.name,
+                field_type=field.field_type,
+                mode=field.mode,
+                description=description,
+                fields=nested_fields
+            )
 
         updated_fields.append(new_field)
 
-    return updated_fields
+    return updated_fields, changed
+
+def update_schema_description(bq_schema_fields, json_schema):
+    """
+    Update the description of BigQuery schema fields based on a JSON schema.
+
+    Args:
+        bq_schema_fields (List[bigquery.SchemaField]): List of BigQuery schema fields.
+        json_schema (dict): JSON schema containing field descriptions.
+
+    Returns:
+        List[bigquery.SchemaField]: Updated list of BigQuery schema fields with updated descriptions, or bq_schema_fields itself if nothing changed.
+    """
+    updated_fields, changed = apply_descriptions(bq_schema_fields, dict(flatten_descriptions(json_schema)))
+    return updated_fields if changed else bq_schema_fields
 
 def update_bigquery_schema_from_json(client, table_id, json_schema_file):
     """
@@ -197,77 +248,254 @@ def update_bigquery_schema_from_json(client, table_id, json_schema_file):
 
     # Update the schema descriptions
     updated_schema = update_schema_description(bq_schema, json_schema['schema'])
+    if updated_schema is bq_schema:
+        # The descriptions are already up to date
+        return
 
     # Update the table with the new schema
     table.schema = updated_schema
     client.update_table(table, ['schema'])
 
-def get_latest_schema_file(table_name, directory="downloads"):
+_thread_local = threading.local()
+
+def get_bigquery_client():
     """
-    Get the latest schema file for a given table name.
+    Get the BigQuery client for the current thread, creating it on first use.
+
+    Returns:
+        bigquery.Client: The BigQuery client owned by the calling thread.
+    """
+    if not hasattr(_thread_local, "client"):
+        _thread_local.client = bigquery.Client()
+    return _thread_local.client
+
+def get_storage_client():
+    """
+    Get the Cloud Storage client for the current thread, creating it on first use.
+
+    Returns:
+        storage.Client: The Cloud Storage client owned by the calling thread.
+    """
+    if not hasattr(_thread_local, "storage_client"):
+        _thread_local.storage_client = storage.Client()
+    return _thread_local.storage_client
+
+def load_parquet_files(table, job_id, parquet_files):
+    """
+    Loads parquet files into the BigQuery table of the same name, replacing its contents.
+
+    The files are staged in the Cloud Storage bucket named by STAGING_BUCKET and loaded
+    from there with a single wildcard load job, so BigQuery copies every part from GCS
+    in parallel instead of receiving them over the load-job upload. Large files are
+    streamed from disk in UPLOAD_CHUNK_SIZE_MB chunks over the calling thread's storage
+    client session, so a file is never read into memory whole. The staged objects are
+    deleted once the load has finished.
 
     Args:
-        table_name (str): The name of the table.
-        directory (str, optional): The directory where the schema files are located. Defaults to "downloads".
+        table (str): The name of the table to load.
+        job_id (str): The DAP job ID the parquet files were downloaded by.
+        parquet_files (List[str]): The paths to the parquet files to load.
 
     Returns:
-        str: The path to the latest schema file, or None if no matching file is found.
+        None
     """
-    schema_file_pattern = re.compile(rf"{table_name}_schema_version_(\d+)\.json")
-    highest_version = 0
-    latest_schema_file = None
+    client = get_bigquery_client()
+    table_ref = DATASET_REF.table(table)
 
-    for file in os.listdir(directory):
-        match = schema_file_pattern.match(file)
-        if match:
-            version = int(match.group(1))
-            if version > highest_version:
-                highest_version = version
-                latest_schema_file = file
+    # Stage parquet files in Cloud Storage
+    bucket = get_storage_client().bucket(STAGING_BUCKET)
+    blobs = []
+    try:
+        for parquet_file in parquet_files:
+            blob = bucket.blob(f"dap/{job_id}/{os.path.basename(parquet_file)}", chunk_size=UPLOAD_CHUNK_SIZE)
+            blob.upload_from_filename(parquet_file)
+            blobs.append(blob)
+
+        # Load all parquet files into BigQuery in one job
+        job = client.load_table_from_uri(f"gs://{STAGING_BUCKET}/dap/{job_id}/*.parquet", table_ref, job_config=LOAD_JOB_CONFIG)
+
+        # Wait for the load job to complete
+        job.result()
+    finally:
+        for blob in blobs:
+            blob.delete()
 
-    return os.path.join(directory, latest_schema_file) if latest_schema_file else None
+def merge_incremental_table(table):
+    """
+    Merges the incremental changes loaded into a table's staging table into the table itself.
 
-# Initialize a BigQuery client
-client = bigquery.Client()
+    Rows DAP marks as deleted are removed, every other row is upserted by its key. The
+    staging table is dropped afterwards.
 
-# List tables
-tables = list_tables()
-if not tables:
-    print("No tables found.")
+    Args:
+        table (str): The name of the table to merge the changes into.
 
-for table in tables:
+    Returns:
+        None
+    """
+    client = get_bigquery_client()
+    staging_table_id = f"{PROJECT}.{DATASET}.{table}{STAGING_TABLE_SUFFIX}"
+
+    query = f"""
+        MERGE `{PROJECT}.{DATASET}.{table}` AS target
+        USING (
+            SELECT key, value, (SELECT AS STRUCT meta.* EXCEPT (action)) AS meta, meta.action AS action
+            FROM `{staging_table_id}`
+            WHERE TRUE
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY TO_JSON_STRING(key) ORDER BY meta.ts DESC) = 1
+        ) AS source
+        ON target.key = source.key
+        WHEN MATCHED AND source.action = 'D' THEN
+            DELETE
+        WHEN MATCHED THEN
+            UPDATE SET value = source.value, meta = source.meta
+        WHEN NOT MATCHED AND source.action != 'D' THEN
+            INSERT (key, value, meta) VALUES (source.key, source.value, source.meta)
+    """
     try:
-        # Download table data
-        download_table_data(table)
+        client.query(query).result()
+    finally:
+        client.delete_table(staging_table_id, not_found_ok=True)
 
-        job_id = get_job_id()
+def load_sync_state():
+    """
+    Loads the time each table was last synced, and the schema version it was synced with, from the 'dap_state' table.
 
-        # Find the downloaded parquet file
-        parquet_files = glob.glob(f'downloads/{job_id}/*.parquet')
-        if not parquet_files:
-            print(f"No parquet files found for job {job_id}.")
-            continue
-        parquet_file = parquet_files[0]
+    Returns:
+        dict: Dicts with the "last_sync" datetime and "schema_version" keyed by table name, empty if the state table does not exist yet.
+    """
+    try:
+        rows = get_bigquery_client().list_rows(STATE_TABLE_REF)
+        return {row["table_name"]: {"last_sync": row["last_sync"], "schema_version": row.get("schema_version")} for row in rows}
+    except NotFound:
+        return {}
 
-        table_ref = client.dataset(os.getenv("DATASET")).table(table)
+def save_sync_state(sync_state):
+    """
+    Replaces the contents of the 'dap_state' table with the given sync state.
 
-        # Load parquet file into BigQuery
-        job_config = bigquery.LoadJobConfig(source_format=bigquery.SourceFormat.PARQUET, write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
-        with open(parquet_file, "rb") as source_file:
-            job = client.load_table_from_file(source_file, table_ref, job_config=job_config)
+    Args:
+        sync_state (dict): Dicts with the "last_sync" datetime and "schema_version" keyed by table name.
 
-        # Wait for the load job to complete
-        job.result()
+    Returns:
+        None
+    """
+    rows = [
+        {"table_name": table, "last_sync": state["last_sync"].isoformat(), "schema_version": state["schema_version"]}
+        for table, state in sync_state.items()
+    ]
+    job_config = bigquery.LoadJobConfig(schema=STATE_SCHEMA, write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+    get_bigquery_client().load_table_from_json(rows, STATE_TABLE_REF, job_config=job_config).result()
+
+def update_table_schema(table, json_schema_file):
+    """
+    Updates the schema descriptions of a BigQuery table from its DAP JSON schema file.
+
+    Args:
+        table (str): The name of the table to update.
+        json_schema_file (str): The path to the JSON schema file.
+
+    Returns:
+        None
+    """
+    update_bigquery_schema_from_json(get_bigquery_client(), f"{PROJECT}.{DATASET}.{table}", json_schema_file)
+
+async def process_table(table, executor, semaphore, sync_state, dap_session):
+    """
+    Downloads a table from DAP, loads it into BigQuery and updates its schema descriptions.
+
+    The table's current schema version is checked before any data is downloaded. A
+    table synced before with that same version only downloads the changes since its
+    last sync and merges them in, and is left untouched if there are none. A table that
+    is new, or whose schema version changed, gets a full snapshot that replaces it. On
+    success the table's entry in sync_state is moved to the timestamp DAP returned for
+    the download: the snapshot's 'at' or the increment's 'until', which is what the
+    next incremental query must start from.
+
+    Each table is downloaded into its own freshly created subdirectory of 'downloads'
+    so that tables processed concurrently, or left over from earlier runs, never share
+    a directory. DAP requests run on the event loop, while the blocking BigQuery calls
+    run on the given executor.
+
+    Args:
+        table (str): The name of the table to process.
+        executor (ThreadPoolExecutor): The executor to run BigQuery calls on.
+        semaphore (asyncio.Semaphore): Bounds the number of tables processed at once.
+        sync_state (dict): Dicts with the "last_sync" datetime and "schema_version" keyed by table name.
+        dap_session (DAPSession): The DAP API session to download the table with.
+
+    Returns:
+        None
+    """
+    async with semaphore:
+        loop = asyncio.get_running_loop()
+        download_directory = tempfile.mkdtemp(prefix=f"{table}_", dir="downloads")
+        try:
+            # Download table schema
+            schema_version, schema_file = await download_table_schema(dap_session, table, SCHEMA_CACHE_DIRECTORY)
+
+            state = sync_state.get(table)
+            # Changes in a new schema version cannot be merged into the old table
+            incremental = state is not None and state["schema_version"] == schema_version
+            if state is not None and not incremental:
+                logging.info(f"Schema of table {table} changed to version {schema_version}, reloading from a snapshot.")
+
+            # Download table data
+            if incremental:
+                result = await download_incremental_table_data(dap_session, table, state["last_sync"], download_directory)
+                if result.schema_version != schema_version:
+                    logging.warning(f"Schema of table {table} changed to version {result.schema_version} during the download, it will be reloaded on the next run.")
+                    return
+            else:
+                result = await download_table_data(dap_session, table, download_directory)
+            schema_version = result.schema_version
+
+            # Find the downloaded parquet files
+            parquet_files = [file for file in result.downloaded_files if file.endswith(".parquet")]
+            if not parquet_files:
+                if incremental:
+                    sync_state[table] = {"last_sync": result.timestamp, "schema_version": schema_version}
+                    logging.info(f"Table {table} is unchanged.")
+                else:
+                    logging.warning(f"No parquet files found for table {table}.")
+                return
+            job_id = result.job_id
+
+            if incremental:
+                await loop.run_in_executor(executor, load_parquet_files, f"{table}{STAGING_TABLE_SUFFIX}", job_id, parquet_files)
+                await loop.run_in_executor(executor, merge_incremental_table, table)
+            else:
+                await loop.run_in_executor(executor, load_parquet_files, table, job_id, parquet_files)
+
+            await loop.run_in_executor(executor, update_table_schema, table, schema_file)
+
+            sync_state[table] = {"last_sync": result.timestamp, "schema_version": schema_version}
+            logging.info(f"Table {table} loaded to BigQuery.")
+        except Exception as e:
+            logging.error(f"Error loading table {table} to BigQuery: {e}")
+        finally:
+            # Clean up downloaded files
+            shutil.rmtree(download_directory, ignore_errors=True)
+
+async def main():
+    os.makedirs("downloads", exist_ok=True)
+    os.makedirs(SCHEMA_CACHE_DIRECTORY, exist_ok=True)
+
+    semaphore = asyncio.Semaphore(MAX_WORKERS)
+    credentials = Credentials.create(client_id=API_KEY, client_secret=API_SECRET)
+    async with DAPClient(DAP_BASE_URL, credentials) as dap_session:
+        # List tables
+        tables = await list_tables(dap_session)
+        if not tables:
+            logging.warning("No tables found.")
 
-        # Download table schema
-        download_table_schema(table)
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            loop = asyncio.get_running_loop()
+            sync_state = await loop.run_in_executor(executor, load_sync_state)
 
-        update_bigquery_schema_from_json(client, f"{os.getenv('PROJECT')}.{os.getenv('DATASET')}.{table}", get_latest_schema_file(table))
+            await asyncio.gather(*(process_table(table, executor, semaphore, sync_state, dap_session) for table in tables))
 
-        logging.info(f"Table {table} loaded to BigQuery.")
+            await loop.run_in_executor(executor, save_sync_state, sync_state)
 
-        # Clean up downloaded files
-        os.remove(parquet_file)
-        shutil.rmtree(os.path.dirname(parquet_file))
-    except Exception as e:
-        logging.error(f"Error loading table {table} to BigQuery: {e}")
\ No newline at end of file
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,238 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import pytest
+
+for name in ("API_KEY", "API_SECRET", "DATASET", "PROJECT", "STAGING_BUCKET"):
+    os.environ.setdefault(name, "test")
+
+from dap.dap_types import DownloadTableDataResult, IncrementalQuery, SnapshotQuery, VersionedSchema
+from google.cloud import bigquery
+
+import main
+
+
+def make_schema():
+    return [
+        bigquery.SchemaField("key", "RECORD", fields=[
+            bigquery.SchemaField("id", "INTEGER", description="The ID."),
+        ]),
+        bigquery.SchemaField("value", "RECORD", fields=[
+            bigquery.SchemaField("name", "STRING", description="The name."),
+            bigquery.SchemaField("nested", "RECORD", fields=[
+                bigquery.SchemaField("flag", "BOOLEAN", description="A flag."),
+            ]),
+        ]),
+        bigquery.SchemaField("other", "STRING"),
+    ]
+
+
+JSON_SCHEMA = {
+    "properties": {
+        "key": {"properties": {"id": {"description": "The ID."}}},
+        "value": {
+            "properties": {
+                "name": {"description": "The name."},
+                "nested": {"properties": {"flag": {"description": "A flag."}}},
+            }
+        },
+    }
+}
+
+
+def test_update_schema_description_returns_unchanged_nested_schema():
+    schema = make_schema()
+
+    assert main.update_schema_description(schema, JSON_SCHEMA) is schema
+
+
+def test_update_schema_description_rebuilds_only_changed_fields():
+    schema = make_schema()
+    json_schema = {
+        "properties": {
+            **JSON_SCHEMA["properties"],
+            "value": {
+                "properties": {
+                    "name": {"description": "The name."},
+                    "nested": {"properties": {"flag": {"description": "x" * 2000}}},
+                }
+            },
+        }
+    }
+
+    updated = main.update_schema_description(schema, json_schema)
+
+    assert updated is not schema
+    assert updated[0] is schema[0]
+    assert updated[2] is schema[2]
+    assert updated[1].fields[0].description == "The name."
+    assert updated[1].fields[1].fields[0].description == "x" * main.MAX_DESCRIPTION_LENGTH
+
+
+class FakeClient:
+    def __init__(self, schema):
+        self.table = bigquery.Table("project.dataset.table", schema=schema)
+        self.updated = []
+        self.loads = []
+        self.queries = []
+        self.deleted = []
+
+    def get_table(self, table_id):
+        return self.table
+
+    def update_table(self, table, fields):
+        self.updated.append((table, fields))
+
+    def load_table_from_uri(self, source_uris, destination, job_config=None):
+        self.loads.append((source_uris, destination, job_config))
+        return FakeJob()
+
+    def query(self, query):
+        self.queries.append(query)
+        return FakeJob()
+
+    def delete_table(self, table, not_found_ok=False):
+        self.deleted.append(table)
+
+
+class FakeJob:
+    def result(self):
+        pass
+
+
+class FakeStorageClient:
+    def bucket(self, name):
+        return self
+
+    def blob(self, name, chunk_size=None):
+        return self
+
+    def upload_from_filename(self, filename):
+        pass
+
+    def delete(self):
+        pass
+
+
+class FakeDAPSession:
+    def __init__(self, schema_version, downloaded_files, timestamp):
+        self.schema_version = schema_version
+        self.downloaded_files = downloaded_files
+        self.timestamp = timestamp
+        self.queries = []
+
+    async def get_table_schema(self, namespace, table):
+        return VersionedSchema(schema={"properties": {}}, version=self.schema_version)
+
+    async def download_table_data(self, namespace, table, query, output_directory):
+        self.queries.append(query)
+        return DownloadTableDataResult(self.schema_version, self.timestamp, "job-1", self.downloaded_files)
+
+
+def write_schema_file(tmp_path, json_schema):
+    schema_file = tmp_path / "table_schema_version_1.json"
+    schema_file.write_bytes(main.orjson.dumps({"schema": json_schema, "version": 1}))
+    return str(schema_file)
+
+
+def test_update_bigquery_schema_from_json_skips_unchanged_schema(tmp_path):
+    client = FakeClient(make_schema())
+
+    main.update_bigquery_schema_from_json(client, "project.dataset.table", write_schema_file(tmp_path, JSON_SCHEMA))
+
+    assert client.updated == []
+
+
+def test_update_bigquery_schema_from_json_updates_changed_schema(tmp_path):
+    client = FakeClient(make_schema())
+    json_schema = {"properties": {"other": {"description": "Something else."}}}
+
+    main.update_bigquery_schema_from_json(client, "project.dataset.table", write_schema_file(tmp_path, json_schema))
+
+    assert client.updated == [(client.table, ["schema"])]
+    assert client.table.schema[2].description == "Something else."
+
+
+LAST_SYNC = datetime(2024, 1, 1, tzinfo=timezone.utc)
+TIMESTAMP = datetime(2024, 1, 2, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("downloads")
+    os.makedirs(main.SCHEMA_CACHE_DIRECTORY)
+
+    client = FakeClient(make_schema())
+    monkeypatch.setattr(main, "get_bigquery_client", lambda: client)
+    monkeypatch.setattr(main, "get_storage_client", FakeStorageClient)
+    return client
+
+
+def run_process_table(sync_state, dap_session):
+    async def run():
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            await main.process_table("accounts", executor, asyncio.Semaphore(1), sync_state, dap_session)
+
+    asyncio.run(run())
+
+
+def assert_snapshot_loaded(client, dap_session):
+    assert [type(query) for query in dap_session.queries] == [SnapshotQuery]
+    [(source_uris, destination, job_config)] = client.loads
+    assert destination == main.DATASET_REF.table("accounts")
+    assert job_config.write_disposition == bigquery.WriteDisposition.WRITE_TRUNCATE
+    assert client.queries == []
+
+
+def test_process_table_without_state_loads_snapshot(client):
+    dap_session = FakeDAPSession(2, ["downloads/job_1/part-0.parquet"], TIMESTAMP)
+    sync_state = {}
+
+    run_process_table(sync_state, dap_session)
+
+    assert_snapshot_loaded(client, dap_session)
+    assert sync_state == {"accounts": {"last_sync": TIMESTAMP, "schema_version": 2}}
+
+
+def test_process_table_with_same_schema_version_merges_increment(client):
+    dap_session = FakeDAPSession(2, ["downloads/job_1/part-0.parquet"], TIMESTAMP)
+    sync_state = {"accounts": {"last_sync": LAST_SYNC, "schema_version": 2}}
+
+    run_process_table(sync_state, dap_session)
+
+    [query] = dap_session.queries
+    assert isinstance(query, IncrementalQuery)
+    assert query.since == LAST_SYNC
+    [(source_uris, destination, job_config)] = client.loads
+    assert destination == main.DATASET_REF.table(f"accounts{main.STAGING_TABLE_SUFFIX}")
+    [merge] = client.queries
+    assert "MERGE" in merge
+    assert client.deleted == [f"{main.PROJECT}.{main.DATASET}.accounts{main.STAGING_TABLE_SUFFIX}"]
+    assert sync_state == {"accounts": {"last_sync": TIMESTAMP, "schema_version": 2}}
+
+
+def test_process_table_with_empty_increment_leaves_table_unchanged(client):
+    dap_session = FakeDAPSession(2, [], TIMESTAMP)
+    sync_state = {"accounts": {"last_sync": LAST_SYNC, "schema_version": 2}}
+
+    run_process_table(sync_state, dap_session)
+
+    assert [type(query) for query in dap_session.queries] == [IncrementalQuery]
+    assert client.loads == []
+    assert client.queries == []
+    assert client.updated == []
+    assert sync_state == {"accounts": {"last_sync": TIMESTAMP, "schema_version": 2}}
+
+
+@pytest.mark.parametrize("synced_schema_version", [1, None])
+def test_process_table_with_changed_or_unknown_schema_version_loads_snapshot(client, synced_schema_version):
+    dap_session = FakeDAPSession(2, ["downloads/job_1/part-0.parquet"], TIMESTAMP)
+    sync_state = {"accounts": {"last_sync": LAST_SYNC, "schema_version": synced_schema_version}}
+
+    run_process_table(sync_state, dap_session)
+
+    assert_snapshot_loaded(client, dap_session)
+    assert sync_state == {"accounts": {"last_sync": TIMESTAMP, "schema_version": 2}}